@@ -1,3 +1,8 @@
+import base64
+import os
+import queue
+import zlib
+from collections import Counter, OrderedDict
 from btpeer import *
 
 
@@ -20,7 +25,7 @@ class Signal(object):
 
 
 class REPLY(Signal):
-    signal_name = 'REPLS'
+    signal_name = 'REPL'
 
 
 class ERROR(Signal):
@@ -38,65 +43,131 @@ class LISTPEERS(Signal):
     signal_name = 'LIST'
     
     def handle_message(self, btpeer, peerconn, data):
-        btpeer.peerlock.acquire()
+        peers = btpeer.peers.snapshot()  # count and entries always agree.
+        peerconn.senddata(REPLY.signal_name, '{}'.format(len(peers)))
+        for pid, record in peers.items():
+            peerconn.senddata(REPLY.signal_name, '{} {} {}'.format(pid, record.host, record.port))  # 多条回复
+
+
+class LISTCHANGES(Signal):
+    """
+    Versioned LIST. The request carries the '<epoch> <version>' of the 
+    peer list last received from this peer, or nothing. The one reply is 
+    either 'DELTA <epoch> <version>' followed by lines '+ peerid host port' 
+    and '- peerid' for the peers added and removed since then, or, when 
+    the requester is too far behind, 'FULL <epoch> <version>' followed by 
+    the whole list ('peerid host port' lines), zlib compressed and base64 
+    encoded.
+    """
+    signal_name = 'LSTV'
+
+    def handle_message(self, btpeer, peerconn, data):
         try:
-            peerconn.senddata(REPLY.signal_name, '{}'.format(btpeer.number_of_peers()))
-            for pid in btpeer.peers:
-                host, port = btpeer.getpeer(pid)
-                peerconn.senddata(REPLY.signal_name, '{} {} {}'.format(pid, host, port))  # 多条回复
-        finally:
-            btpeer.peerlock.release()
+            epoch, since = data.split() if data.strip() else (None, None)
+            since = int(since) if since is not None else None
+        except:
+            peerconn.senddata(ERROR.signal_name, 'List: incorrect arguments')
+            return None
+        epoch, version, full, entries = btpeer.peers.changes(epoch, since)
+        if full:
+            lines = '\n'.join('{} {} {}'.format(r.peerid, r.host, r.port) for r in entries)
+            body = base64.b64encode(zlib.compress(lines.encode('utf-8'))).decode('ascii')
+            peerconn.senddata(REPLY.signal_name, 'FULL {} {}\n{}'.format(epoch, version, body))
+        else:
+            lines = ['DELTA {} {}'.format(epoch, version)]
+            for pid, record in entries:
+                if record is None:
+                    lines.append('- {}'.format(pid))
+                else:
+                    lines.append('+ {} {} {}'.format(pid, record.host, record.port))
+            peerconn.senddata(REPLY.signal_name, '\n'.join(lines))
 
 
 class INSERTPEER(Signal):
     signal_name = 'JOIN'
     
     def handle_message(self, btpeer, peerconn, data):
-        btpeer.peerlock.acquire()
         try:
             peerid, host, port = data.split()
             if btpeer.maxpeer_searched():
                 peerconn.senddata(ERROR.signal_name, 'Join: too many peers')
                 return None
-            if peerid not in btpeer.peers and peerid != btpeer.myid:
-                btpeer.addpeer(peerid, host, port)
+            if peerid != btpeer.myid and btpeer.addpeer(peerid, host, port):
                 peerconn.senddata(REPLY.signal_name, 'Join: peer added: {}'.format(peerid))
+            elif btpeer.maxpeer_searched():  # filled up by a concurrent join.
+                peerconn.senddata(ERROR.signal_name, 'Join: too many peers')
             else:
                 peerconn.senddata(ERROR.signal_name, 'Join: peer already inserted {}'.format(peerid))
         except:
             peerconn.senddata(ERROR.signal_name, 'Join: incorrect arguments')
-        finally:
-            btpeer.peerlock.release()
 
 
 class QUERY(Signal):
     signal_name = 'QUER'
+    closed_reply = 'Query: search closed'
     
     def handle_message(self, btpeer, peerconn, data):
         try:
-            peerid, key, ttl = data.split()  # ttl: search depth
-            peerconn.senddata(REPLY.signal_name, 'Query ACK: {}'.format(key))
+            peerid, key, ttl, *searchid = data.split()  # ttl: search depth, searchid: optional, see FilePeer.search
+            ttl = int(ttl)
+            searchid = searchid[0] if searchid else None
         except:
             peerconn.senddata(ERROR.signal_name, 'Query: incorrect arguments')
-        t = threading.Thread(target=self.__process_query, args=(btpeer, peerid, key, int(ttl)))
-        t.start()
+            return None
+        if btpeer.searchclosed(peerid, searchid):  # tells the sender to stop propagating the query too.
+            peerconn.senddata(ERROR.signal_name, self.closed_reply)
+            return None
+        peerconn.senddata(REPLY.signal_name, 'Query ACK: {}'.format(key))
+        btpeer.transport.spawn(self.__process_query, btpeer, peerid, key, ttl, searchid)
     
-    def __process_query(self, btpeer, peerid, key, ttl):
-        for fname in btpeer.files:
-            if key in fname:
-                fpeerid = btpeer.files[fname]
-                if fpeerid is None: fpeerid = btpeer.myid
-                host, port = peerid.split(':')
-                msgdata = '{} {}'.format(fname, fpeerid)
-                # 妙啊，peerid里直接包含了host和port，在这里不一定是直接邻居，只传id就可以有足够的信息进行连接
-                # can't use sendtopeer here because peerid is not necessarily an immediate neighbor.
-                btpeer.connect_and_send(host, int(port), QRESPONSE.signal_name, msgdata, pid=peerid)
-        # will only reach here if key not found...
-        # in which case propagate query to neighbors
+    def __process_query(self, btpeer, peerid, key, ttl, searchid):
+        if btpeer.searchclosed(peerid, searchid):
+            return None
+        matches = [(fname, fpeerid) for fname, fpeerid in list(btpeer.files.items()) if key in fname]
+        if btpeer.replicas is not None:  # advertise our cached copies instead of their origin.
+            cached = set(fname for fname in btpeer.replicas.names() if key in fname)
+            matches = [(fname, fpeerid) for fname, fpeerid in matches if fname not in cached]
+            matches += [(fname, None) for fname in sorted(cached)]
+        for fname, fpeerid in matches:
+            btpeer.countrequest(fname)
+            if fpeerid is None: fpeerid = btpeer.myid
+            host, port = peerid.split(':')
+            msgdata = '{} {}'.format(fname, fpeerid)
+            if searchid is not None:
+                msgdata += ' {}'.format(searchid)
+            # 妙啊，peerid里直接包含了host和port，在这里不一定是直接邻居，只传id就可以有足够的信息进行连接
+            # can't use sendtopeer here because peerid is not necessarily an immediate neighbor.
+            resp = btpeer.connect_and_send(host, int(port), QRESPONSE.signal_name, msgdata, pid=peerid)
+            if resp and resp[0][0] == ERROR.signal_name:  # the searcher has enough results.
+                btpeer.closesearch(peerid, searchid)
+                return None
+        # propagate query to neighbors
         if ttl > 0:
             msgdata = '{} {} {}'.format(peerid, key, ttl-1)
-            for nextpid in btpeer.peers:
-                btpeer.send2peer(nextpid, QUERY.signal_name, msgdata)
+            if searchid is not None:
+                msgdata += ' {}'.format(searchid)
+            for nextpid in btpeer.peers.snapshot():
+                if btpeer.searchclosed(peerid, searchid):
+                    break
+                resp = btpeer.send2peer(nextpid, QUERY.signal_name, msgdata)
+                if resp and resp[0] == (ERROR.signal_name, QUERY.closed_reply):
+                    btpeer.closesearch(peerid, searchid)
+                    break
+
+
+class QUERYCANCEL(Signal):
+    signal_name = 'QCAN'
+
+    def handle_message(self, btpeer, peerconn, data):
+        try:
+            peerid, searchid, ttl = data.split()
+            ttl = int(ttl)
+        except:
+            peerconn.senddata(ERROR.signal_name, 'Cancel: incorrect arguments')
+            return None
+        peerconn.senddata(REPLY.signal_name, 'Cancel ACK: {}'.format(searchid))
+        if btpeer.closesearch(peerid, searchid) and ttl > 0:  # forward a cancel only once.
+            btpeer.transport.spawn(btpeer.cancelsearch, peerid, searchid, ttl - 1)
 
 
 class QRESPONSE(Signal):
@@ -104,13 +175,20 @@ class QRESPONSE(Signal):
 
     def handle_message(self, btpeer, peerconn, data):
         try:
-            fname, fpeerid = data.split()
+            fname, fpeerid, *searchid = data.split()
+            searchid = searchid[0] if searchid else None
             if fname in btpeer.files:
                 pass  # Can't add duplicate file.
             else:
                 btpeer.files[fname] = fpeerid
+            btpeer.addsource(fname, fpeerid)
         except:
             traceback.print_exc()
+            return None
+        if btpeer.deliverresult(fname, fpeerid, searchid):
+            peerconn.senddata(REPLY.signal_name, 'Response: more')
+        else:  # tells the responder to stop propagating the query.
+            peerconn.senddata(ERROR.signal_name, 'Response: search closed')
 
 
 class FILEGET(Signal):
@@ -118,7 +196,11 @@ class FILEGET(Signal):
 
     def handle_message(self, btpeer, peerconn, data):
         fname = data
-        if fname not in btpeer.files:
+        file_data = btpeer.replicas.get(fname) if btpeer.replicas is not None else None
+        if file_data is not None:
+            btpeer.countfetch(fname)
+            peerconn.senddata(REPLY.signal_name, file_data)
+        elif fname not in btpeer.files:
             peerconn.senddata(ERROR.signal_name, 'File not found.')
         else:
             try:
@@ -127,6 +209,7 @@ class FILEGET(Signal):
             except:
                 peerconn.senddata(ERROR.signal_name, 'Error reading file.')
             else:
+                btpeer.countfetch(fname)
                 peerconn.senddata(REPLY.signal_name, file_data)
 
 
@@ -134,32 +217,248 @@ class PEERQUIT(Signal):
     signal_name = 'QUIT'
 
     def handle_message(self, btpeer, peerconn, data):
-        btpeer.peerlock.acquire()
-        try:
-            peerid = data.strip()
-            if str(peerid) in btpeer.peers:
-                msg = 'Quit: peer removed: {}'.format(peerid)
-                peerconn.senddata(REPLY.signal_name, msg)
-                btpeer.removepeer(peerid)
-            else:
-                msg = 'Quit: peer not found: {}'.format(peerid)
-                peerconn.senddata(ERROR.signal_name, msg)
-        finally:
-            btpeer.peerlock.release()
+        peerid = data.strip()
+        if btpeer.peers.remove(str(peerid)):
+            msg = 'Quit: peer removed: {}'.format(peerid)
+            peerconn.senddata(REPLY.signal_name, msg)
+        else:
+            msg = 'Quit: peer not found: {}'.format(peerid)
+            peerconn.senddata(ERROR.signal_name, msg)
+
+
+class SearchHandle(object):
+    """
+    Handle of a search started with FilePeer.search().
+    Iterate it (from a single consumer) to get (fname, fpeerid) results as 
+    they arrive, or pass a callback. The search ends at its deadline, once 
+    <limit> results came in, or on cancel(). onclose(handle) is called 
+    once when the search ends before its deadline.
+    """
+    def __init__(self, key, deadline=None, limit=None, callback=None, clock=time.time, searchid=None, onclose=None):
+        self.key = key
+        self.searchid = searchid  # carried by the queries and responses of this search.
+        self.limit = limit
+        self.callback = callback
+        self.onclose = onclose
+        self.clock = clock
+        self.started = clock()
+        self.deadline = self.started + deadline if deadline is not None else None
+        self.hits = 0  # number of distinct results.
+        self.first_result_latency = None  # seconds from start to the first result.
+        self.__seen = set()
+        self.__results = queue.Queue()  # results, then None once the search is over.
+        self.__closed = False
+        self.__lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.__closed or (self.deadline is not None and self.clock() >= self.deadline)
+
+    def add_result(self, fname, fpeerid) -> bool:
+        """ Record a result, return False if the search no longer wants any. """
+        closed = False
+        with self.__lock:
+            if self.done:
+                return False
+            if (fname, fpeerid) in self.__seen:
+                return True
+            self.__seen.add((fname, fpeerid))
+            self.hits += 1
+            if self.first_result_latency is None:
+                self.first_result_latency = self.clock() - self.started
+            self.__results.put((fname, fpeerid))
+            if self.limit is not None and self.hits >= self.limit:
+                closed = self.__close()
+        if self.callback is not None:
+            self.callback(fname, fpeerid)
+        if closed and self.onclose is not None:
+            self.onclose(self)
+        return True
+
+    def cancel(self):
+        """ Stop the search, results already received can still be iterated. """
+        with self.__lock:
+            closed = self.__close()
+        if closed and self.onclose is not None:
+            self.onclose(self)
+
+    def __close(self):
+        if self.__closed:
+            return False
+        self.__closed = True
+        self.__results.put(None)
+        return True
+
+    def __iter__(self):
+        while True:
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(0, self.deadline - self.clock())
+            try:
+                result = self.__results.get(timeout=timeout)
+            except queue.Empty:
+                self.cancel()
+                return
+            if result is None:
+                return
+            yield result
+
+    def __repr__(self):
+        return 'SearchHandle({} {}, hits={}, done={})'.format(self.key, self.searchid, self.hits, self.done)
+
+
+class ClosedSearches(object):
+    """
+    Thread-safe, bounded set of the (peerid, searchid) of searches whose 
+    searcher needs no more results, the oldest ones are forgotten first.
+    """
+    def __init__(self, maxsize=1024, keys=()):
+        self.maxsize = maxsize
+        self.__keys = OrderedDict()
+        self.__lock = threading.Lock()
+        for peerid, searchid in keys:
+            self.add(peerid, searchid)
+
+    def add(self, peerid, searchid) -> bool:
+        """ Close the search, return False if it was closed already. """
+        with self.__lock:
+            if (peerid, searchid) in self.__keys:
+                return False
+            self.__keys[(peerid, searchid)] = True
+            while len(self.__keys) > self.maxsize:
+                self.__keys.popitem(last=False)
+            return True
+
+    def keys(self):
+        return list(self.__keys)
+
+    def __contains__(self, key):
+        return key in self.__keys
+
+    def __len__(self):
+        return len(self.__keys)
+
+
+PeerStateManager.register('ClosedSearches', ClosedSearches, exposed=('add', 'keys', '__contains__', '__len__'))
+
+
+class ReplicaCache(object):
+    """
+    Size-capped store of files downloaded from other peers, the least 
+    recently used ones are evicted first.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity  # bytes.
+        self.size = 0
+        self.__files = OrderedDict()  # fname --> file data, least recently used first.
+        self.__lock = threading.Lock()
+
+    def get(self, fname):
+        """ Return the cached data of <fname>, or None. """
+        with self.__lock:
+            data = self.__files.get(fname, None)
+            if data is not None:
+                self.__files.move_to_end(fname)
+            return data
+
+    def put(self, fname, data) -> bool:
+        """ Cache <fname>, evicting other files as needed. Return False if it can never fit. """
+        nbytes = len(data.encode('utf-8'))
+        if nbytes > self.capacity:
+            return False
+        with self.__lock:
+            old = self.__files.pop(fname, None)
+            if old is not None:
+                self.size -= len(old.encode('utf-8'))
+            while self.__files and self.size + nbytes > self.capacity:
+                _, evicted = self.__files.popitem(last=False)
+                self.size -= len(evicted.encode('utf-8'))
+            self.__files[fname] = data
+            self.size += nbytes
+            return True
+
+    def names(self):
+        return list(self.__files)
+
+    def __contains__(self, fname):
+        return fname in self.__files
+
+    def __len__(self):
+        return len(self.__files)
+
+
+PeerStateManager.register('ReplicaCache', ReplicaCache, exposed=('get', 'put', 'names', '__contains__', '__len__'))
+
+
+class FileStats(object):
+    """
+    Thread-safe popularity counters of a FilePeer: how many times each file 
+    answered a query (requests) or was downloaded (fetches) here, and up 
+    to <maxsources> peers known to have it.
+    """
+    def __init__(self, maxsources=8, requests=None, fetches=None, sources=None):
+        self.maxsources = maxsources
+        self.requests = Counter(requests or {})  # fname --> number of queries it answered here.
+        self.fetches = Counter(fetches or {})  # fname --> number of times it was downloaded from or by this peer.
+        self.sources = dict(sources or {})  # fname --> peer ids that answered a query with it.
+        self.__lock = threading.Lock()
+
+    def countrequest(self, fname):
+        with self.__lock:
+            self.requests[fname] += 1
+
+    def countfetch(self, fname):
+        with self.__lock:
+            self.fetches[fname] += 1
+
+    def counts(self, fname):
+        """ Return the (requests, fetches) of <fname>. """
+        with self.__lock:
+            return (self.requests[fname], self.fetches[fname])
+
+    def addsource(self, fname, fpeerid):
+        with self.__lock:
+            sources = self.sources.setdefault(fname, [])
+            if fpeerid not in sources and len(sources) < self.maxsources:
+                sources.append(fpeerid)
+
+    def getsources(self, fname):
+        with self.__lock:
+            return list(self.sources.get(fname, []))
+
+    def state(self):
+        """ Return the (requests, fetches, sources) to build a copy from. """
+        with self.__lock:
+            return (dict(self.requests), dict(self.fetches), {f: list(s) for f, s in self.sources.items()})
+
+
+PeerStateManager.register('FileStats', FileStats, exposed=('countrequest', 'countfetch', 'counts', 'addsource', 'getsources', 'state'))
 
 
 class FilePeer(BTPeer):
     """
     Implement a file-sharing peer-to-peer entity based on the generic P2P network.
     """
-    def __init__(self, maxpeers, serverhost, serverport):
+    def __init__(self, maxpeers, serverhost, serverport, transport=None):
         super().__init__(
             maxpeers=maxpeers,
             serverhost=serverhost,
             serverport=serverport,
-            myid=':'.join([str(serverhost), str(serverport)])
+            myid=':'.join([str(serverhost), str(serverport)]),
+            transport=transport,
         )
         self.files = {}  # available files: name --> peerid mapping
+        self.peerviews = {}  # (host, port) --> (epoch, version, peers) last received with LSTV.
+        self.maxlistsize = 1 << 20  # bytes, bound on a decompressed FULL peer list.
+        self.searches = []  # SearchHandle of our searches still running.
+        self.opensearchids = {}  # searchid --> (key, deadline) of self.searches, shared with worker processes.
+        self.searchresults = None  # queue of the results worker processes received, see share_state.
+        self.searchowner = os.getpid()  # the process holding self.searches.
+        self.closedsearches = ClosedSearches()  # queries whose searcher has enough results, shared with worker processes.
+        self.searchlock = threading.Lock()
+        self.filestats = FileStats()  # shared with worker processes, like self.replicas.
+        self.replicas = None  # ReplicaCache, see enable_replication().
+        self.hotthreshold = None
         self.router = self.__router
         # handlers = {
         #     LISTPEERS: self.__handle_listpeers,
@@ -172,9 +471,11 @@ class FilePeer(BTPeer):
         # }
         handlers = {
             LISTPEERS.signal_name: LISTPEERS().handle_message,
+            LISTCHANGES.signal_name: LISTCHANGES().handle_message,
             INSERTPEER.signal_name: INSERTPEER().handle_message,
             PEERNAME.signal_name: PEERNAME().handle_message,
             QUERY.signal_name: QUERY().handle_message,
+            QUERYCANCEL.signal_name: QUERYCANCEL().handle_message,
             QRESPONSE.signal_name: QRESPONSE().handle_message,
             FILEGET.signal_name: FILEGET().handle_message,
             PEERQUIT.signal_name: PEERQUIT().handle_message,
@@ -183,10 +484,11 @@ class FilePeer(BTPeer):
             self.addhandler(key, value)
         
     def __router(self, peerid):
-        if peerid not in self.peers:
+        address = self.getpeer(peerid)
+        if address is None:
             return (None, None, None)
         else:
-            return (peerid, *self.peers[peerid])
+            return (peerid, *address)
     
     # def __handle_insertpeer(self, peerconn, data):
     #     self.peerlock.acquire()
@@ -268,18 +570,13 @@ class FilePeer(BTPeer):
     #             peerconn.senddata(REPLY, file_data)
 
     def __handle_quit(self, peerconn, data):
-        self.peerlock.acquire()
-        try:
-            peerid = data.strip()
-            if str(peerid) in self.peers:
-                msg = 'Quit: peer removed: {}'.format(peerid)
-                peerconn.senddata(REPLY.signal_name, msg)
-                self.removepeer(peerid)
-            else:
-                msg = 'Quit: peer not found: {}'.format(peerid)
-                peerconn.senddata(ERROR.signal_name, msg)
-        finally:
-            self.peerlock.release()
+        peerid = data.strip()
+        if self.peers.remove(str(peerid)):
+            msg = 'Quit: peer removed: {}'.format(peerid)
+            peerconn.senddata(REPLY.signal_name, msg)
+        else:
+            msg = 'Quit: peer not found: {}'.format(peerid)
+            peerconn.senddata(ERROR.signal_name, msg)
     
     def buildpeers(self, host, port, hops=1):  # depth-first search
         if not self.maxpeer_searched() and hops > 0:
@@ -288,19 +585,236 @@ class FilePeer(BTPeer):
                 _, peerid = self.connect_and_send(host, port, PEERNAME.signal_name, '')[0]
                 msgdata = '{} {} {}'.format(self.myid, self.serverhost, self.serverport)
                 resp = self.connect_and_send(host, port, INSERTPEER.signal_name, msgdata)[0]
-                if resp[0] == REPLY.signal_name and peerid not in self.peers:
-                    self.addpeer(peerid, host, port)
-                    resp = self.connect_and_send(host, port, LISTPEERS.signal_name, '', pid=peerid)
-                    if len(resp) > 1:
-                        resp.reverse()
-                        resp.pop()
-                        for item in resp:
-                            nextpid, host, port = item[1].split()
-                            if nextpid != self.myid:
-                                self.buildpeers(host, port, hops-1)
+                if resp[0] == REPLY.signal_name and self.addpeer(peerid, host, port):
+                    peers = self.syncpeers(host, port, pid=peerid)
+                    for nextpid, (host, port) in reversed(list(peers.items())):
+                        if nextpid != self.myid:
+                            self.buildpeers(host, port, hops-1)
             except:
                 traceback.print_exc()
                 self.removepeer(peerid)
+
+    def syncpeers(self, host, port, pid=None):
+        """
+        Return the peer list (peerid --> (host, port)) of the peer at host:port.
+        Only the changes since the previous call are transferred (LSTV), 
+        peers that do not understand LSTV are asked with LIST instead.
+        """
+        key = (str(host), int(port))
+        epoch, version, peers = self.peerviews.get(key, (None, None, {}))
+        msgdata = '{} {}'.format(epoch, version) if epoch is not None else ''
+        resp = self.connect_and_send(host, port, LISTCHANGES.signal_name, msgdata, pid=pid)
+        if not resp or resp[0][0] != REPLY.signal_name:
+            self.peerviews.pop(key, None)
+            resp = self.connect_and_send(host, port, LISTPEERS.signal_name, '', pid=pid)
+            peers = {}
+            for _, item in resp[1:]:
+                nextpid, nexthost, nextport = item.split()
+                peers[nextpid] = (nexthost, int(nextport))
+            return peers
+        header, _, body = resp[0][1].partition('\n')
+        kind, epoch, version = header.split()
+        if kind == 'FULL':
+            decompressor = zlib.decompressobj()
+            body = decompressor.decompress(base64.b64decode(body), self.maxlistsize)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise MsgError('List: peer list too large or truncated')
+            body = body.decode('utf-8')
+            peers = {}
+            for line in body.splitlines():
+                nextpid, nexthost, nextport = line.split()
+                peers[nextpid] = (nexthost, int(nextport))
+        else:
+            peers = dict(peers)
+            for line in body.splitlines():
+                op, nextpid, *address = line.split()
+                if op == '+':
+                    peers[nextpid] = (address[0], int(address[1]))
+                else:
+                    peers.pop(nextpid, None)
+        self.peerviews[key] = (epoch, int(version), peers)
+        return peers
     
+    def search(self, key, ttl=4, deadline=10.0, limit=None, callback=None):
+        """
+        Query the network for files whose name contains <key> and return a 
+        SearchHandle receiving the results. Results are also added to 
+        self.files as before. Once the handle is done, peers answering the 
+        query are told so and stop propagating it, and when it ends early 
+        (limit or cancel) a cancel is sent as far as the query went. 
+        Queries carry a random search id, so this only affects this search, 
+        not later ones for the same key.
+        """
+        searchid = '{:08x}'.format(self.transport.random.getrandbits(32))
+        onclose = lambda h: self.transport.spawn(self.cancelsearch, self.myid, searchid, ttl)
+        handle = SearchHandle(key, deadline=deadline, limit=limit, callback=callback, 
+                              clock=self.transport.now, searchid=searchid, onclose=onclose)
+        with self.searchlock:
+            self.__prunesearches()
+            self.searches.append(handle)
+            self.opensearchids[searchid] = (key, handle.deadline)
+        msgdata = '{} {} {} {}'.format(self.myid, key, ttl, searchid)
+        self.transport.spawn(self.__sendsearch, handle, msgdata)
+        return handle
+
+    def __sendsearch(self, handle, msgdata):
+        for pid in self.getpeerids():
+            if handle.done:
+                break
+            self.send2peer(pid, QUERY.signal_name, msgdata)
+
+    def __prunesearches(self):
+        # call with searchlock held.
+        for handle in self.searches:
+            if handle.done:
+                self.opensearchids.pop(handle.searchid, None)
+        self.searches = [h for h in self.searches if not h.done]
+
+    def opensearches(self, fname, searchid=None):
+        """
+        Return the running searches that <fname> is a result of: the one 
+        with <searchid>, or those whose key matches for responses from 
+        peers that do not send search ids.
+        """
+        with self.searchlock:
+            self.__prunesearches()
+            if searchid is not None:
+                return [h for h in self.searches if h.searchid == searchid]
+            return [h for h in self.searches if h.key in fname]
+
+    def deliverresult(self, fname, fpeerid, searchid=None) -> bool:
+        """
+        Hand a query response to the searches it belongs to. Return False if 
+        none of them wants more results.
+        """
+        if os.getpid() != self.searchowner:
+            # a worker process: the handles live in the process that called search().
+            now = self.transport.now()
+            if searchid is not None:
+                entries = [self.opensearchids.get(searchid, None)]
+            else:
+                entries = list(self.opensearchids.values())
+            wanted = any(entry is not None and entry[0] in fname and (entry[1] is None or now < entry[1])
+                         for entry in entries)
+            if wanted:
+                self.searchresults.put((fname, fpeerid, searchid))
+            return wanted
+        wanted = False
+        for handle in self.opensearches(fname, searchid):
+            wanted = handle.add_result(fname, fpeerid) or wanted
+        return wanted
+
+    def __pumpresults(self):
+        """ Hand the results received by worker processes to our search handles. """
+        while True:
+            try:
+                fname, fpeerid, searchid = self.searchresults.get()
+            except:
+                return None  # the coordinator has shut down.
+            self.deliverresult(fname, fpeerid, searchid)
+
+    def closesearch(self, peerid, searchid) -> bool:
+        """
+        Remember that the search <searchid> of <peerid> needs no more results.
+        Return False if it was known to be closed already.
+        """
+        if searchid is None:
+            return False
+        return self.closedsearches.add(peerid, searchid)
+
+    def cancelsearch(self, peerid, searchid, ttl):
+        """
+        Close the search <searchid> of <peerid> here and send a cancel to 
+        our neighbors, which pass it on while <ttl> allows (QCAN).
+        """
+        self.closesearch(peerid, searchid)
+        msgdata = '{} {} {}'.format(peerid, searchid, ttl)
+        for pid in self.getpeerids():
+            self.send2peer(pid, QUERYCANCEL.signal_name, msgdata)
+
+    def searchclosed(self, peerid, searchid):
+        return searchid is not None and (peerid, searchid) in self.closedsearches
+
+    def share_state(self, manager):
+        super().share_state(manager)
+        self.files = manager.dict(self.files)
+        self.opensearchids = manager.dict(self.opensearchids)
+        self.closedsearches = manager.ClosedSearches(self.closedsearches.maxsize, self.closedsearches.keys())
+        self.filestats = manager.FileStats(self.filestats.maxsources, *self.filestats.state())
+        if self.replicas is not None:
+            replicas = manager.ReplicaCache(self.replicas.capacity)
+            for fname in self.replicas.names():  # least recently used first, as in the cache.
+                replicas.put(fname, self.replicas.get(fname))
+            self.replicas = replicas
+        self.searchresults = manager.Queue()
+
+    def startcoordinator(self, workers=0):
+        started = self.manager is not None
+        manager = super().startcoordinator(workers)
+        if not started:  # the workers are forked by now, threads are safe to start.
+            t = threading.Thread(target=self.__pumpresults)
+            t.daemon = True
+            t.start()
+        return manager
+
+    def enable_replication(self, capacity, hotthreshold=2):
+        """
+        Keep a copy of downloaded files that were requested or fetched at 
+        least <hotthreshold> times through this peer, in a ReplicaCache of 
+        <capacity> bytes. Cached copies are served by FILEGET and advertised 
+        in query responses, which spreads the load of popular files.
+        With worker processes, call this before startcoordinator().
+        """
+        if self.manager is not None:
+            raise RuntimeError('Replication must be enabled before startcoordinator().')
+        self.replicas = ReplicaCache(capacity)
+        self.hotthreshold = hotthreshold
+
+    def countrequest(self, fname):
+        self.filestats.countrequest(fname)
+
+    def countfetch(self, fname):
+        self.filestats.countfetch(fname)
+
+    def popularity(self, fname):
+        """ Return how many times <fname> was requested or fetched through this peer. """
+        return sum(self.filestats.counts(fname))
+
+    def addsource(self, fname, fpeerid):
+        """ Remember <fpeerid> as one of the peers <fname> can be fetched from. """
+        self.filestats.addsource(fname, fpeerid)
+
+    def fetch(self, fname, fpeerid=None):
+        """
+        Download <fname> and return its content, or None on failure.
+        Without <fpeerid>, the peers known to have the file are tried in 
+        random order, so that requests for a popular file spread over its 
+        copies. Hot files are kept in the replica cache, if enabled.
+        """
+        if self.replicas is not None:
+            data = self.replicas.get(fname)
+            if data is not None:
+                return data
+        if fpeerid is not None:
+            candidates = [fpeerid]
+        else:
+            candidates = self.filestats.getsources(fname)
+            owner = self.files.get(fname, None)
+            if owner is not None and owner not in candidates:
+                candidates.append(owner)
+            self.transport.random.shuffle(candidates)
+        for pid in candidates:
+            if pid == self.myid:
+                continue
+            host, port = pid.split(':')
+            resp = self.connect_and_send(host, port, FILEGET.signal_name, fname, pid=pid)
+            if len(resp) and resp[0][0] == REPLY.signal_name:
+                data = resp[0][1]
+                self.countfetch(fname)
+                if self.replicas is not None and self.popularity(fname) >= self.hotthreshold:
+                    self.replicas.put(fname, data)
+                return data
+        return None
+
     def add_local_file(self, filename):
         self.files[filename] = None
@@ -2,22 +2,203 @@ import socket
 import struct
 import threading
 import time
+import random
 import traceback
 import logging
+import multiprocessing
+from multiprocessing.managers import SyncManager
 
 logging.basicConfig(level=logging.DEBUG)
 
 
+class PeerRecord(object):
+    """
+    Compact record of a known peer.
+    Records are never modified once published in a PeerTable, use 
+    PeerTable.update() to replace one with changed fields.
+    """
+    __slots__ = ('peerid', 'host', 'port', 'rtt', 'health', 'flags', 'lastseen')
+
+    def __init__(self, peerid, host, port, rtt=None, health=0, flags=0, lastseen=None):
+        self.peerid = peerid
+        self.host, self.port = host, int(port)
+        self.rtt = rtt  # seconds taken by the last successful ping, None if never pinged.
+        self.health = health  # number of consecutive failed pings.
+        self.flags = flags  # capability bit flags advertised by the peer.
+        self.lastseen = lastseen if lastseen is not None else time.time()
+
+    @property
+    def address(self):
+        return (self.host, self.port)
+
+    def replace(self, **fields):
+        """ Return a copy of this record with the given fields changed. """
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(fields)
+        return PeerRecord(**values)
+
+    def __repr__(self):
+        return 'PeerRecord({}, {}:{})'.format(self.peerid, self.host, self.port)
+
+
+class PeerTable(object):
+    """
+    Thread-safe table of known peers: peerid --> PeerRecord.
+    Writes are serialized and copy-on-write, each one publishes a new dict. 
+    Readers take snapshot() and iterate it without any lock, a snapshot is 
+    never modified after it has been published.
+    Every add or remove bumps the table version and is kept in a bounded 
+    change log, so that changes() can tell another peer what changed since 
+    the version it last saw. The epoch tells versions of different tables 
+    (or of a restarted peer) apart.
+    """
+    def __init__(self, maxpeers=-1, historysize=256, rng=None):
+        self.maxpeers = int(maxpeers)  # -1 allows an unlimited number of peers.
+        self.historysize = historysize  # number of adds and removes kept for changes().
+        rng = rng if rng is not None else tcp_transport.random
+        self.epoch = '{:08x}'.format(rng.getrandbits(32))
+        self.__lock = threading.Lock()  # serializes writers only.
+        self.__state = ({}, 0, ())  # (peers, version, change log), published together.
+
+    def snapshot(self):
+        """ Return the current peerid --> PeerRecord mapping. Do not modify it. """
+        return self.__state[0]
+
+    def get(self, peerid):
+        """ Return the PeerRecord for the given peer id, or None. """
+        return self.__state[0].get(peerid, None)
+
+    def version(self):
+        """ Return the (epoch, version) of the current snapshot. """
+        return (self.epoch, self.__state[1])
+
+    def changes(self, epoch=None, since=None):
+        """
+        changes(epoch, since) -> (epoch, version, full, entries)
+        Return what changed after version <since> of <epoch>: with full 
+        False, entries is a list of (peerid, record) where record is None 
+        for a removed peer. With full True, because the change log does not 
+        reach back that far (or since is from another epoch, or the delta 
+        would be bigger), entries is the list of all current records.
+        """
+        peers, version, log = self.__state
+        first = log[0][0] if log else version + 1
+        if epoch == self.epoch and since is not None and first - 1 <= since <= version:
+            delta = {}
+            for v, peerid, record in log:
+                if v > since:
+                    delta[peerid] = record
+            if len(delta) <= len(peers):
+                return (self.epoch, version, False, list(delta.items()))
+        return (self.epoch, version, True, list(peers.values()))
+
+    def __publish(self, peers, changed):
+        _, version, log = self.__state
+        if changed:
+            log += tuple((version + i, peerid, record) for i, (peerid, record) in enumerate(changed, 1))
+            log = log[max(0, len(log) - self.historysize):]
+            version += len(changed)
+        self.__state = (peers, version, log)
+
+    def add(self, peerid, host, port, flags=0, lastseen=None) -> bool:
+        """
+        Add a peer unless it is already known or the table is full.
+        Return True if the peer was added.
+        """
+        with self.__lock:
+            peers = self.__state[0]
+            if peerid in peers or (self.maxpeers != -1 and len(peers) >= self.maxpeers):
+                return False
+            newpeers = dict(peers)
+            record = newpeers[peerid] = PeerRecord(peerid, host, port, flags=flags, lastseen=lastseen)
+            self.__publish(newpeers, [(peerid, record)])
+            return True
+
+    def update(self, peerid, **fields) -> bool:
+        """ Replace the record of a known peer with the given fields changed. """
+        with self.__lock:
+            peers = self.__state[0]
+            record = peers.get(peerid, None)
+            if record is None:
+                return False
+            newpeers = dict(peers)
+            newpeers[peerid] = record.replace(**fields)
+            self.__publish(newpeers, [])  # same members, the version does not change.
+            return True
+
+    def remove(self, *peerids) -> int:
+        """ Remove the given peers, return the number of peers removed. """
+        with self.__lock:
+            peers = self.__state[0]
+            todelete = [pid for pid in dict.fromkeys(peerids) if pid in peers]
+            if todelete:
+                newpeers = dict(peers)
+                for pid in todelete:
+                    del newpeers[pid]
+                self.__publish(newpeers, [(pid, None) for pid in todelete])
+            return len(todelete)
+
+    def __contains__(self, peerid):
+        return peerid in self.__state[0]
+
+    def __iter__(self):
+        return iter(self.__state[0])
+
+    def __len__(self):
+        return len(self.__state[0])
+
+
+class PeerStateManager(SyncManager):
+    """
+    Coordinator process owning the state shared by the worker processes 
+    of a multi-process peer (see BTPeer.main_loop). 
+    Besides the usual SyncManager types it serves PeerTable.
+    """
+
+
+PeerStateManager.register('PeerTable', PeerTable, exposed=('snapshot', 'get', 'version', 'changes', 'add', 'update', 'remove'))
+
+
+class TCPTransport(object):
+    """
+    Default transport of a peer: real sockets, threads and wall clock.
+    A transport provides connect(host, port) returning a connected 
+    socket-like object, spawn(target, *args) to run a task concurrently 
+    and now() for the current time (see btsim.SimTransport). Its random 
+    attribute is the random.Random that peer code should draw from.
+    """
+    def __init__(self):
+        self.random = random.Random()
+
+    def connect(self, host, port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((host, int(port)))
+        return s
+
+    def spawn(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.start()
+        return t
+
+    def now(self):
+        return time.time()
+
+
+tcp_transport = TCPTransport()
+
+
 class BTPeer(object):
     """ Implements the core functionality that might be used by a peer in a P2P networks. """
-    def __init__(self, maxpeers, serverport, serverhost, myid=None, router=None, stabilizer=None):
+    def __init__(self, maxpeers, serverport, serverhost, myid=None, router=None, stabilizer=None, transport=None):
         self.maxpeers = int(maxpeers)  # maxpeers may be set to -1 to allow unlimited number of peers.
         self.serverhost, self.serverport = serverhost, int(serverport)
         self.myid = myid if myid is not None else ':'.join([str(self.serverhost), str(self.serverport)])
-        self.peerlock = threading.Lock()  # ensure proper access to peers list.
-        self.peers = {}
+        self.transport = transport if transport is not None else tcp_transport
+        self.peers = PeerTable(self.maxpeers, rng=self.transport.random)  # known peers, safe to read from any thread.
         self.handlers = {}
         self.shutdown = False
+        self.manager = None  # PeerStateManager once startcoordinator() has run.
+        self.workerprocs = []  # worker processes forked by startcoordinator().
 
         self.router = router
         """
@@ -33,7 +214,7 @@ class BTPeer(object):
         """
         self.stabilizer = stabilizer
 
-    def __handlepeer(self, clientsock):
+    def handlepeer(self, clientsock):
         """ Dispatches messages from the socket connection """
         host, port = clientsock.getpeername()
         print('handlepeer: host: {} port: {}'.format(host, port))
@@ -73,45 +254,49 @@ class BTPeer(object):
         """
         self.handlers[msgtype] = handler
     
-    def addpeer(self, peerid, host, port) -> bool:
+    def addpeer(self, peerid, host, port, flags=0) -> bool:
         """ Add a peer name and host:port mapping to the known list of peers. """
-        if peerid not in self.peers and (self.maxpeers == -1 or len(self.peers) < self.maxpeers):
-            self.peers[peerid] = (host, int(port))
-            return True
-        else:
-            return False
+        return self.peers.add(peerid, host, port, flags=flags, lastseen=self.transport.now())
     
     def getpeer(self, peerid):
         """ Return the (host, port) tuple for the given peer name. """
-        return self.peers.get(peerid, None)
+        record = self.peers.get(peerid)
+        return record.address if record is not None else None
 
     def removepeer(self, peerid):
         """ Remove peer information from the known list of peers. """
-        if peerid in self.peers:
-            del self.peers[peerid]
+        self.peers.remove(peerid)
     
     def getpeerids(self):
         """ Return a list of all known peer id. """
-        return list(self.peers.keys())
+        return list(self.peers.snapshot())
     
     def number_of_peers(self):
         """ Return the number of known peers. """
-        return len(self.peers)
+        return len(self.peers.snapshot())
     
     def maxpeer_searched(self):
         """
         Return whether the maximum limit of peer has been added to the list 
-        of known peers. Always return True if maxpeers is set to -1
+        of known peers. Always return False if maxpeers is set to -1
         """
-        assert self.maxpeers == -1 or len(self.peers) <= self.maxpeers
-        return self.maxpeers > -1 and len(self.peers) == self.maxpeers
+        npeers = len(self.peers.snapshot())
+        assert self.maxpeers == -1 or npeers <= self.maxpeers
+        return self.maxpeers > -1 and npeers == self.maxpeers
     
-    def make_server_socket(self, port, backlog=5):
+    def make_server_socket(self, port, backlog=5, reuseport=False):
         """
         Construct and prepare a server socket listening on the given port.
+        With reuseport several processes may bind the same port, the kernel 
+        then spreads incoming connections among them.
         """
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                s.close()
+                raise OSError('SO_REUSEPORT is not supported on this platform.')
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.bind(('', port))
         s.listen(backlog)
         return s
@@ -141,7 +326,7 @@ class BTPeer(object):
         """
         msgreply = []
         try:
-            peerconn = BTPeerConnection(pid, host, port)
+            peerconn = BTPeerConnection(pid, host, port, transport=self.transport)
             peerconn.senddata(msgtype, msgdata)
             if waitreply:
                 onereply = peerconn.recvdata()
@@ -155,35 +340,108 @@ class BTPeer(object):
             traceback.print_exc()
         return msgreply
 
-    def check_live_peers(self):
+    def check_live_peers(self, maxfailures=1):
         """
         Attemp to ping all currently known peers in order to ensure that 
-        they still active. Remove any from the peer list that do not reply.
+        they still active. Remove any from the peer list that fail to answer 
+        <maxfailures> pings in a row, and refresh the rtt and last seen time 
+        of the others.
         This function can be used as a simple stabilizer.
         """
         todelete = []
-        for pid in self.peers:
-            is_connected = False
+        for pid, record in self.peers.snapshot().items():
+            start = self.transport.now()
+            try:
+                peerconn = BTPeerConnection(pid, record.host, record.port, transport=self.transport)
+            except:
+                health = record.health + 1
+                if health >= maxfailures:
+                    todelete.append(pid)
+                else:
+                    self.peers.update(pid, health=health)
+                continue
+            try:
+                peerconn.senddata('PING', '')  # 发送成功就认为是在连接
+            finally:
+                peerconn.close()
+            now = self.transport.now()
+            self.peers.update(pid, rtt=now - start, health=0, lastseen=now)
+        self.peers.remove(*todelete)
+    
+    def share_state(self, manager):
+        """
+        Move the state that handlers modify into the coordinator <manager>, 
+        so that every worker process sees the same peers.
+        Subclasses holding more state should extend this.
+        """
+        peers = manager.PeerTable(self.maxpeers)
+        for record in self.peers.snapshot().values():
+            peers.add(record.peerid, record.host, record.port, flags=record.flags)
+        self.peers = peers
+
+    def startcoordinator(self, workers=0):
+        """
+        Start the PeerStateManager coordinator, move the shared state into 
+        it (see share_state) and fork <workers> worker processes that each 
+        bind the server port with SO_REUSEPORT and run their own accept loop.
+        Call this before starting any thread (stabilizer, main_loop, GUI): 
+        forking while another thread holds a lock can deadlock the workers, 
+        and a write landing between the copy and the swap would be lost. 
+        main_loop(workers > 1) calls it if it has not run yet.
+        """
+        if self.manager is None:
+            ctx = multiprocessing.get_context('fork')  # workers inherit handlers, SO_REUSEPORT is unix only anyway.
+            manager = PeerStateManager(ctx=ctx)
+            manager.start()
             try:
-                host, port = self.peers[pid]
-                peerconn = BTPeerConnection(pid, host, port)
-                peerconn.senddata('PING', '')
-                is_connected = True  # 发送成功就认为是在连接
+                self.share_state(manager)
+                for _ in range(workers):
+                    p = ctx.Process(target=self.__run_worker, daemon=True)
+                    p.start()
+                    self.workerprocs.append(p)
             except:
-                todelete.append(pid)
-                if is_connected:
-                    peerconn.close()
-        
-        self.peerlock.acquire()
+                self.__stopworkers()
+                manager.shutdown()
+                raise
+            self.manager = manager
+        return self.manager
+
+    def main_loop(self, workers=1):
+        """
+        Accept and dispatch connections until shutdown.
+        With workers > 1, the connections are accepted by the worker 
+        processes of startcoordinator(workers), this process then only 
+        supervises them (and runs the stabilizer if one was started).
+        """
+        if workers > 1:
+            self.__serve_multiprocess(workers)
+        else:
+            self.__accept_loop(self.make_server_socket(self.serverport))
+
+    def __serve_multiprocess(self, workers):
         try:
-            for pid in todelete:
-                if pid in self.peers:
-                    del self.peers[pid]
+            self.startcoordinator(workers)
+            while not self.shutdown and any(p.is_alive() for p in self.workerprocs):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print('KeyboardInterrupt ......')
+            self.shutdown = True
         finally:
-            self.peerlock.release()
-    
-    def main_loop(self):
-        s = self.make_server_socket(self.serverport)
+            self.__stopworkers()
+            if self.manager is not None:
+                self.manager.shutdown()
+
+    def __stopworkers(self):
+        for p in self.workerprocs:
+            p.terminate()
+        for p in self.workerprocs:
+            p.join()
+        self.workerprocs = []
+
+    def __run_worker(self):
+        self.__accept_loop(self.make_server_socket(self.serverport, reuseport=True))
+
+    def __accept_loop(self, s):
         # s.settimeout(3)  # 让下面的socket.accept()超时，进入下一次循环，否则程序会一直卡在accept那里, new: 现在没必要了，最外面将进程设置为守护状态
         while not self.shutdown:
             try:
@@ -191,8 +449,7 @@ class BTPeer(object):
                 clientsock, clientaddr = s.accept()
                 print('----main_loop-----: clientsock: {}, clientaddr: {}'.format(clientsock, clientaddr))
                 clientsock.settimeout(None)
-                t = threading.Thread(target=self.__handlepeer, args=(clientsock,))
-                t.start()
+                self.transport.spawn(self.handlepeer, clientsock)
             except KeyboardInterrupt:
                 print('KeyboardInterrupt ......')
                 self.shutdown = True
@@ -203,19 +460,20 @@ class BTPeer(object):
 
 
 class BTPeerConnection(object):
-    def __init__(self, peerid, host, port, sock=None):
+    def __init__(self, peerid, host, port, sock=None, transport=None):
         self.id = peerid
         if not sock:
-            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.s.connect((host, int(port)))
+            transport = transport if transport is not None else tcp_transport
+            self.s = transport.connect(host, port)
         else:
             self.s = sock
-        self.sd = self.s.makefile('rw', 65536)
+        self.sd = self.s.makefile('rwb', 65536)
 
     def __makemsg(self, msgtype, msgdata):
         print(msgtype)
+        msgdata = msgdata.encode('utf-8')  # the length field counts bytes, not characters.
         msglen = len(msgdata)
-        msg = struct.pack("!4sL%ds" % msglen, msgtype.encode('utf-8'), msglen, msgdata.encode('utf-8'))
+        msg = struct.pack("!4sL%ds" % msglen, msgtype.encode('utf-8'), msglen, msgdata)
         return msg
     
     def senddata(self, msgtype, msgdata) -> bool:
@@ -226,7 +484,7 @@ class BTPeerConnection(object):
     
         try:
             msg = self.__makemsg(msgtype, msgdata)
-            self.sd.write(msg.decode('utf-8'))
+            self.sd.write(msg)
             self.sd.flush()
         except KeyboardInterrupt:
             raise
@@ -245,8 +503,8 @@ class BTPeerConnection(object):
             msgtype = self.sd.read(4)
             if not msgtype: return (None, None)
             lenstr = self.sd.read(4)
-            msglen = int(struct.unpack( "!L", lenstr.encode('utf-8') )[0])
-            msg = ""
+            msglen = int(struct.unpack( "!L", lenstr )[0])
+            msg = b""
             while len(msg) != msglen:
                 data = self.sd.read(min(2048, msglen - len(msg)))
                 if not len(data):
@@ -261,7 +519,7 @@ class BTPeerConnection(object):
             traceback.print_exc()
             return (None, None)
         else:
-            return (msgtype, msg)
+            return (msgtype.decode('utf-8'), msg.decode('utf-8'))
     
     def close(self):
         """
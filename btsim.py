@@ -0,0 +1,415 @@
+"""
+Deterministic in-process network simulator.
+
+Peers attached to a SimNetwork talk through SimTransport instead of
+sockets: a connection delivers its request straight into the handler of
+the target peer, tasks that would run on a thread are queued as events,
+and time is a virtual clock advanced by the latency and bandwidth of each
+link. Thousands of FilePeer instances can then run in one process, and
+the same seed always gives the same run.
+
+Usage: python btsim.py number-of-nodes [seed]
+"""
+
+import sys
+import os
+import heapq
+import random
+import socket
+import struct
+import traceback
+import contextlib
+from collections import Counter, defaultdict
+from btfiler import *
+
+
+class Link(object):
+    """ Properties of the link from one simulated address to another. """
+    __slots__ = ('latency', 'bandwidth', 'loss')
+
+    def __init__(self, latency=0.05, bandwidth=None, loss=0.0):
+        self.latency = latency  # seconds.
+        self.bandwidth = bandwidth  # bytes per second, None for unlimited.
+        self.loss = loss  # probability that a connection attempt is lost.
+
+    def delay(self, nbytes):
+        """ Return the time taken to deliver <nbytes> over this link. """
+        if self.bandwidth:
+            return self.latency + nbytes / self.bandwidth
+        return self.latency
+
+
+class SimStats(object):
+    """
+    Counters collected by a SimNetwork.
+    The hop of a message is its causal depth: the number of messages
+    in the chain that led to it, 1 for a message sent by a task that no
+    message triggered.
+    """
+    def __init__(self, start=0.0):
+        self.start = start
+        self.finish = start  # arrival time of the last message delivered.
+        self.messages = Counter()  # msgtype --> number of messages.
+        self.hops = defaultdict(Counter)  # msgtype --> hop --> number of messages.
+        self.receivers = defaultdict(set)  # msgtype --> addresses that received one.
+        self.bytes = 0
+        self.lost = 0  # connection attempts dropped by a lossy link.
+        self.refused = 0  # connection attempts to unknown addresses.
+
+    @property
+    def convergence_time(self):
+        return self.finish - self.start
+
+    def reach(self, msgtype):
+        """ Return the number of distinct nodes that received a <msgtype> message. """
+        return len(self.receivers[msgtype])
+
+    def record(self, msgtype, nbytes, hop, arrival, dst=None):
+        self.messages[msgtype] += 1
+        if dst is not None:
+            self.receivers[msgtype].add(dst)
+        self.hops[msgtype][hop] += 1
+        self.bytes += nbytes
+        self.finish = max(self.finish, arrival)
+
+    def report(self):
+        lines = ['messages: {} ({} bytes), lost: {}, refused: {}, convergence time: {:.3f}s'.format(
+            sum(self.messages.values()), self.bytes, self.lost, self.refused, self.convergence_time)]
+        for msgtype in sorted(self.messages):
+            hops = ' '.join('{}:{}'.format(hop, n) for hop, n in sorted(self.hops[msgtype].items()))
+            lines.append('  {} {:>8}  nodes {:>6}  hops {}'.format(msgtype, self.messages[msgtype], self.reach(msgtype), hops))
+        return '\n'.join(lines)
+
+
+class SimSocket(object):
+    """ One end of a simulated connection, the part of the socket API BTPeerConnection uses. """
+    def __init__(self, network, local, remote):
+        self.network = network
+        self.local, self.remote = local, remote
+        self.other = None  # the opposite end.
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.readyat = 0.0  # virtual time at which inbuf has fully arrived.
+        self.accepting = False  # server end whose handler has not run yet.
+        self.closed = False
+
+    def getpeername(self):
+        return self.remote
+
+    def settimeout(self, timeout):
+        pass
+
+    def makefile(self, mode='rwb', buffering=None):
+        return SimStream(self)
+
+    def close(self):
+        self.closed = True
+
+
+class SimStream(object):
+    """ File object of a SimSocket. """
+    def __init__(self, sock):
+        self.sock = sock
+
+    def read(self, n):
+        sock = self.sock
+        data = bytes(sock.inbuf[:n])
+        del sock.inbuf[:n]
+        sock.network.now = max(sock.network.now, sock.readyat)  # wait for the data to arrive.
+        return data
+
+    def write(self, data):
+        self.sock.outbuf += data
+        return len(data)
+
+    def flush(self):
+        self.sock.network.transmit(self.sock)
+
+
+class SimTransport(object):
+    """ Transport of a peer attached to a SimNetwork (see btpeer.TCPTransport). """
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.random = network.random
+
+    def connect(self, host, port):
+        return self.network.connect(self.address, host, port)
+
+    def spawn(self, target, *args):
+        self.network.schedule(0, target, *args)
+
+    def now(self):
+        return self.network.now
+
+
+class SimNetwork(object):
+    """
+    A simulated network of peers driven by a virtual clock.
+    Each event runs to completion: requests are handled inline by the
+    target peer, while the clock of the running task moves forward by
+    the delay of every message it waits for. Tasks spawned meanwhile are
+    queued at the virtual time they were spawned.
+    """
+    def __init__(self, seed=0, latency=0.05, bandwidth=None, loss=0.0, timeout=3.0):
+        self.random = random.Random(seed)
+        self.defaultlink = Link(latency, bandwidth, loss)
+        self.timeout = timeout  # time wasted by a connection attempt that is lost.
+        self.links = {}  # (src, dst) --> Link
+        self.nodes = {}  # (host, port) --> peer
+        self.now = 0.0
+        self.hop = 0
+        self.stats = SimStats()
+        self.__events = []
+        self.__seq = 0  # keeps events at the same time in scheduling order.
+
+    def transport(self, host, port):
+        """
+        Return the SimTransport for a peer at host:port. Create peers with it 
+        (then attach them) so that everything they draw at construction, 
+        like their peer table epoch, comes from the seeded random too.
+        """
+        return SimTransport(self, (str(host), int(port)))
+
+    def attach(self, peer):
+        """ Make <peer> reachable at its server address and talk through this network. """
+        address = (str(peer.serverhost), int(peer.serverport))
+        self.nodes[address] = peer
+        if not (isinstance(peer.transport, SimTransport) and peer.transport.network is self):
+            peer.transport = SimTransport(self, address)
+        return peer
+
+    def detach(self, peer):
+        """ Take <peer> off the network, as if it had crashed. """
+        self.nodes.pop((str(peer.serverhost), int(peer.serverport)), None)
+
+    def setlink(self, src, dst, latency=None, bandwidth=None, loss=None, symmetric=True):
+        """ Override the properties of the link between two (host, port) addresses. """
+        pairs = [(src, dst), (dst, src)] if symmetric else [(src, dst)]
+        for pair in pairs:
+            link = self.link(*pair)
+            self.links[pair] = Link(
+                latency if latency is not None else link.latency,
+                bandwidth if bandwidth is not None else link.bandwidth,
+                loss if loss is not None else link.loss,
+            )
+
+    def link(self, src, dst):
+        return self.links.get((src, dst), self.defaultlink)
+
+    def schedule(self, delay, target, *args):
+        """ Run target(*args) <delay> virtual seconds from now. """
+        self.__seq += 1
+        heapq.heappush(self.__events, (self.now + delay, self.__seq, self.hop, target, args))
+
+    def every(self, interval, target, *args):
+        """ Run target(*args) every <interval> virtual seconds, use run(until=...) to stop. """
+        def repeat():
+            self.schedule(interval, repeat)
+            target(*args)
+        self.schedule(interval, repeat)
+
+    def run(self, until=None):
+        """
+        Process events in virtual time order until there are none left, or
+        the next one is later than <until>. Return the collected SimStats.
+        """
+        horizon = self.now
+        while self.__events:
+            if until is not None and self.__events[0][0] > until:
+                horizon = max(horizon, until)
+                break
+            when, _, hop, target, args = heapq.heappop(self.__events)
+            self.now, self.hop = when, hop
+            try:
+                target(*args)
+            except KeyboardInterrupt:
+                raise
+            except:
+                traceback.print_exc()
+            horizon = max(horizon, self.now)
+        self.now, self.hop = max(horizon, self.stats.finish), 0
+        return self.stats
+
+    def reset_stats(self):
+        """ Start collecting a fresh SimStats from the current virtual time. """
+        self.stats = SimStats(self.now)
+        return self.stats
+
+    def connect(self, src, host, port):
+        dst = (str(host), int(port))
+        if dst not in self.nodes:
+            self.stats.refused += 1
+            raise ConnectionRefusedError('Simulated peer not found: {}:{}'.format(*dst))
+        loss = self.link(src, dst).loss
+        if loss and self.random.random() < loss:
+            self.stats.lost += 1
+            self.now += self.timeout
+            raise socket.timeout('Simulated connection lost: {}:{}'.format(*dst))
+        client, server = SimSocket(self, src, dst), SimSocket(self, dst, src)
+        client.other, server.other = server, client
+        server.accepting = True
+        return client
+
+    def transmit(self, sock):
+        """ Deliver what <sock> has written, handling the request if it opens a connection. """
+        data = bytes(sock.outbuf)
+        sock.outbuf.clear()
+        other = sock.other
+        if not data or other.closed:
+            return
+        arrival = self.now + self.link(sock.local, sock.remote).delay(len(data))
+        for msgtype, nbytes in self.__frames(data):
+            self.stats.record(msgtype, nbytes, self.hop + 1, arrival, sock.remote)
+        other.inbuf += data
+        other.readyat = max(other.readyat, arrival)
+        if other.accepting:
+            other.accepting = False
+            peer = self.nodes.get(other.local)
+            if peer is None:
+                return
+            saved = (self.now, self.hop)
+            self.now, self.hop = arrival, self.hop + 1
+            try:
+                peer.handlepeer(other)
+            finally:
+                self.now, self.hop = saved
+
+    @staticmethod
+    def __frames(data):
+        offset = 0
+        while offset + 8 <= len(data):
+            msgtype, msglen = struct.unpack_from('!4sL', data, offset)
+            yield msgtype.decode('utf-8', 'replace'), 8 + msglen
+            offset += 8 + msglen
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('Syntax: number-of-nodes [seed]')
+        sys.exit(1)
+    nnodes = int(sys.argv[1])
+    seed = int(sys.argv[2]) if len(sys.argv) >= 3 else 0
+    network = SimNetwork(seed=seed)
+    rnd = network.random
+    peers = []
+    for i in range(nnodes):
+        host = '10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255)
+        transport = network.transport(host, 9000)
+        peers.append(network.attach(FilePeer(maxpeers=5, serverhost=host, serverport=9000, transport=transport)))
+    phases = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # peers print every message.
+        joined = [peers[0]]  # peers of the overlay that may still have room.
+        for peer in peers[1:]:
+            network.schedule(rnd.random(), join, peer, joined, rnd)
+        phases.append(('buildpeers', network.run()))
+        components = count_components(network, peers)
+
+        network.reset_stats()
+        owner, origin = rnd.choice(peers), rnd.choice(peers)
+        owner.add_local_file('simulated.txt')
+        search = origin.search('simulated', ttl=4)
+        query = network.run()
+        phases.append(('query', query))
+
+        network.reset_stats()
+        for peer in rnd.sample(peers, nnodes // 10):
+            network.detach(peer)
+        for peer in peers:
+            network.schedule(rnd.random(), peer.check_live_peers)
+        phases.append(('check_live_peers (10% of nodes gone)', network.run()))
+
+        network.reset_stats()
+        checks = []
+        for _ in range(2):  # the second round is all deltas.
+            checks.append(check_syncpeers(network, peers))
+            network.run()
+        phases.append(('syncpeers, twice', network.stats))
+
+    for name, stats in phases:
+        print('== {}'.format(name))
+        print(stats.report())
+    print('overlay components: {}'.format(components))
+    reach = len(query.receivers[QUERY.signal_name] | {(str(origin.serverhost), int(origin.serverport))})
+    print('query reach: {} of {} nodes, hits: {}, first result after: {}'.format(
+        reach, nnodes, search.hits, search.first_result_latency))
+    for check in checks:
+        print('peer list views checked: {checked} ({incremental} incremental), out of sync: {mismatched}'.format(**check))
+    if any(check['mismatched'] for check in checks):
+        sys.exit(1)
+
+
+def join(peer, joined, rnd, links=2, attempts=10):
+    """
+    Link <peer> to <links> random members of <joined> that still have 
+    room, trying another one when a join is refused, then add <peer> to 
+    <joined>. Each join takes one slot from each side (hops=1): a 
+    transitive join would fill the neighbors too, and the overlay would 
+    end up as closed cliques with no room left for newcomers. The first 
+    link ties every peer to the overlay, which stays connected.
+    """
+    for _ in range(attempts):
+        if peer.number_of_peers() >= links or not joined:
+            break
+        i = rnd.randrange(len(joined))
+        first = joined[i]
+        if first.maxpeer_searched():
+            joined[i] = joined[-1]
+            joined.pop()
+            continue
+        if first.myid not in peer.peers:
+            peer.buildpeers(first.serverhost, first.serverport, 1)
+    joined.append(peer)
+
+
+def count_components(network, peers):
+    """ Return the number of connected components of the overlay formed by the peer tables. """
+    neighbors = defaultdict(set)
+    for peer in peers:
+        address = (str(peer.serverhost), int(peer.serverport))
+        for record in peer.peers.snapshot().values():
+            neighbors[address].add(record.address)
+            neighbors[record.address].add(address)
+    seen, components = set(), 0
+    for peer in peers:
+        address = (str(peer.serverhost), int(peer.serverport))
+        if address in seen:
+            continue
+        components += 1
+        stack = [address]
+        seen.add(address)
+        while stack:
+            for other in neighbors[stack.pop()]:
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+    return components
+
+
+def check_syncpeers(network, peers):
+    """
+    Schedule every attached peer to sync the peer lists of its attached 
+    neighbors and compare each view with the neighbor's actual table.
+    Return a Counter of views 'checked', updated 'incremental'ly and 
+    'mismatched', filled in as the network runs.
+    """
+    check = Counter(checked=0, incremental=0, mismatched=0)
+
+    def sync(peer):
+        for pid, record in peer.peers.snapshot().items():
+            neighbor = network.nodes.get(record.address)
+            if neighbor is None:
+                continue
+            check['incremental'] += record.address in peer.peerviews
+            view = peer.syncpeers(record.host, record.port, pid=pid)
+            check['checked'] += 1
+            check['mismatched'] += view != {p: r.address for p, r in neighbor.peers.snapshot().items()}
+
+    for peer in peers:
+        if network.nodes.get((str(peer.serverhost), int(peer.serverport))) is peer:
+            network.schedule(0, sync, peer)
+    return check
+
+
+if __name__ == '__main__':
+    main()
@@ -10,19 +10,23 @@ from btfiler import *
 
 
 class BTGui(tk.Frame):
-    def __init__(self, serverhost, serverport, firstpeer=None, hops=2, maxpeers=5, master=None):
+    def __init__(self, serverhost, serverport, firstpeer=None, hops=2, maxpeers=5, workers=1, cachesize=0, master=None):
+        self.btpeer = FilePeer(maxpeers=maxpeers, serverhost=serverhost, serverport=serverport)
+        if cachesize > 0:
+            self.btpeer.enable_replication(cachesize)
+        if workers > 1:
+            self.btpeer.startcoordinator(workers)  # forks, so before Tk or any other thread starts.
         tk.Frame.__init__(self, master)
         self.pack()
         self.createWidgets()
         self.master.title('File Sharing App - {}:{}'.format(serverhost, serverport))
-        self.btpeer = FilePeer(maxpeers=maxpeers, serverhost=serverhost, serverport=serverport)
         self.bind("<Destroy>", self.__onDestroy)
         if firstpeer is not None:
             host, port = firstpeer.split(':')
             self.btpeer.buildpeers(host, int(port), hops=hops)
             self.update_peer_list()
         
-        t = threading.Thread(target=self.btpeer.main_loop)
+        t = threading.Thread(target=self.btpeer.main_loop, args=(workers,))
         t.setDaemon(True)
         t.start()
     
@@ -40,7 +44,7 @@ class BTGui(tk.Frame):
     def update_peer_list(self):
         if self.peerList.size() > 0:
             self.peerList.delete(0, self.peerList.size() - 1)
-        for p in self.btpeer.peers:
+        for p in self.btpeer.getpeerids():
             self.peerList.insert(tk.END, p)
         
     def update_file_list(self):
@@ -130,21 +134,18 @@ class BTGui(tk.Frame):
     def onSearch(self):
         key = self.searchEntry.get()
         self.searchEntry.delete(0, len(key))
-        ttl = 4
-        msgdata = '{} {} {}'.format(self.btpeer.myid, key, ttl)
-        for p in self.btpeer.peers:
-            self.btpeer.send2peer(p, QUERY.signal_name, msgdata)
+        self.btpeer.search(key.strip(), ttl=4)
     
     def onFetch(self):
         sels = self.fileList.curselection()
         if len(sels) == 1:
             sel = self.fileList.get(sels[0]).split(':')
             if len(sel) > 2:  # fname:host:port
-                fname, host, port = sel
-                resp = self.btpeer.connect_and_send(host, port, FILEGET.signal_name, fname)
-                if len(resp) and resp[0][0] == REPLY.signal_name:
+                fname = sel[0]
+                file_data = self.btpeer.fetch(fname)  # from any known copy, not only the one listed.
+                if file_data is not None:
                     with open(fname, 'w', encoding='utf-8') as f:
-                        f.write(resp[0][1])
+                        f.write(file_data)
                     self.btpeer.files[fname] = None  # it's local now.
 
     def onRemove(self):
@@ -171,22 +172,36 @@ class BTGui(tk.Frame):
 
 
 def main():
-    if len(sys.argv) < 3:
-        print('Syntax: server-host server-port max-peers first-peer-ip:first-peer-port')
+    args = sys.argv[1:]
+    options = {'--workers': 1, '--cache-size': 0}
+    for name in options:
+        if name in args:
+            i = args.index(name)
+            try:
+                options[name] = int(args[i + 1])
+            except (IndexError, ValueError):
+                args = []  # print the syntax below.
+                break
+            del args[i:i + 2]
+    if len(args) < 2:
+        print('Syntax: server-host server-port max-peers first-peer-ip:first-peer-port '
+              '[--workers number-of-processes] [--cache-size replica-cache-bytes]')
         sys.exit(1)
-    serverhost = sys.argv[1]
-    serverport = int(sys.argv[2])
+    serverhost = args[0]
+    serverport = int(args[1])
     maxpeers = 5
     peerid = None
-    if len(sys.argv) >= 4:
-        maxpeers = int(sys.argv[3])
-    if len(sys.argv) >= 5:
-        peerid = sys.argv[4]
+    if len(args) >= 3:
+        maxpeers = int(args[2])
+    if len(args) >= 4:
+        peerid = args[3]
     app = BTGui(
         serverhost=serverhost,
         serverport=serverport,
         maxpeers=maxpeers,
         firstpeer=peerid,
+        workers=options['--workers'],
+        cachesize=options['--cache-size'],
     )
     app.mainloop()
 